@@ -91,10 +91,49 @@ Five built-in commands are overridden:
            (e.g. path/foo and PAth/bar are in the same directory),
            or where the same file may be spelled differently from time
            to time (e.g. path/foo and path/FOO are the same object).
+
+The names of p4 users and whether the p4 server supports move and copy
+are cached in the .hg/cache directory of
+the repository for a number of seconds given by the option
+   --config perfarce.cachettl=300
+Setting it to 0 disables the cache.
+
+When the whole p4 client view is used, only the most recent submitted
+changelists of the client are checked for revisions pushed from hg,
+their number is given by the option
+   --config perfarce.pendinglimit=200
+
+Files are synchronized from the p4 server by several threads when
+the option
+   --config perfarce.parallel=0
+gives their number, and the network buffer size used by p4 is set by
+   --config perfarce.tcpsize=0
+Both are left to the p4 defaults when 0, clone copies them into the
+new repository.
+
+Pull prints the files of each changelist from the p4 server in batches,
+or reads them from the p4 workarea if perfarce.keep is set, with up to
+   --config perfarce.getfile_parallel=8
+batches running at the same time, at most 32. The files and labels
+of the next
+   --config perfarce.pull_prefetch=4
+changelists are read while the current one is being imported, 0 or
+--debug reads them one changelist at a time. Unless perfarce.keep is set,
+the file contents of up to perfarce.pull_prefetch+1 changelists are
+held in memory.
+
+Push writes the file contents into the p4 workarea with up to
+   --config perfarce.push_parallel=8
+files being written at the same time.
+
+p4unshelve looks up the changelists of the shelved file revisions with
+up to
+   --config perfarce.unshelve_parallel=8
+p4 commands running at the same time.
 '''
 from __future__ import print_function
 from mercurial import commands, context, copies, encoding, error, extensions, hg, phases, pycompat, registrar, scmutil, util
-from mercurial.node import hex, short, nullid
+from mercurial.node import bin, hex, short, nullid
 from mercurial.i18n import _
 from mercurial.error import ConfigError
 try:
@@ -102,7 +141,8 @@ try:
 except ImportError:
     # Mercurial 5.1.2 and older
     from mercurial.repository import peer as peerrepository
-import marshal, os, re, string, sys
+from concurrent import futures
+import codecs, collections, contextlib, functools, hashlib, io, itertools, marshal, os, re, shlex, subprocess, sys, threading, time
 propertycache=util.propertycache
 
 try:
@@ -173,15 +213,20 @@ except ImportError:
     # Mercurial 5.7.1 and older
     from mercurial.util import urllocalpath
 
-if sys.version[0] == '2':
-    # py2 must use os.popen, because there marshal wants a true file
+try:
+    from mercurial.utils.procutil import popen
+except ImportError:
+    # Mercurial 4.5.3 and older
     from os import popen
+
+if os.name == 'nt':
+    def p4argv(cmdline):
+        'command line for subprocess, CreateProcess does the quote removal'
+        return pycompat.fsdecode(cmdline)
 else:
-    try:
-        from mercurial.utils.procutil import popen
-    except ImportError:
-        # Mercurial 4.5.3 and older
-        from os import popen
+    def p4argv(cmdline):
+        'split a shell quoted command line so that p4 runs without a shell'
+        return [pycompat.fsencode(a) for a in shlex.split(pycompat.fsdecode(cmdline))]
 
 
 file = open
@@ -200,6 +245,14 @@ else:
     def revpairnodes(repo, rev):
         return scmutil.revpair(repo, rev)
 
+if tuple(util.version().split(b".",2)) < (b"5",b"5"):
+    # Mercurial 5.4.2 and older
+    def prefetchfiles(repo, ctx, files):
+        scmutil.prefetchfiles(repo, [ctx.rev()], scmutil.matchfiles(repo, files))
+else:
+    def prefetchfiles(repo, ctx, files):
+        scmutil.prefetchfiles(repo, [(ctx.rev(), scmutil.matchfiles(repo, files))])
+
 if tuple(util.version().split(b".",2)) < (b"6",b"4"):
     # Mercurial 6.3.3 and older
     class peer:
@@ -254,6 +307,13 @@ class p4repo(peer):
         raise error.Abort(_(b'%s not supported for p4') % str.encode(a))
 
 
+_RE_TYPE = re.compile(br'([a-z]+)?(text|binary|symlink|apple|resource|unicode|utf\d+)(\+\w+)?$')
+_RE_KEYWORDS = re.compile(br'\$(Id|Header|Date|DateTime|Change|File|Revision|Author):[^$\n]*\$')
+_RE_KEYWORDS_OLD = re.compile(br'\$(Id|Header):[^$\n]*\$')
+_RE_HGID = re.compile(br'{{mercurial (([0-9a-f]{40})(:([0-9a-f]{40}))?)}}')
+_RE_CHANGENO = re.compile(br'Change ([0-9]+) created.+')
+
+
 def loaditer(f):
     "Yield the dictionary objects generated by p4"
     try:
@@ -265,6 +325,17 @@ def loaditer(f):
     except EOFError:
         pass
 
+def numbered(d, name):
+    "List the numbered fields of a p4 object, e.g. job0, job1, ... for job"
+    values = []
+    i = 0
+    while True:
+        v = d.get(b'%s%d' % (name, i))
+        if v is None:
+            return values
+        values.append(v)
+        i += 1
+
 class p4notclient(error.Abort):
     "Exception raised when a path is not a p4 client or invalid"
     pass
@@ -296,11 +367,13 @@ class TempFile:
         except Exception:
             pass
 
+_RE_DOSPATH = re.compile(br'[a-z]:\\', re.I)
+
 def int_to_bytes(x):
     if isinstance(x, bytes):
         return x
 
-    return str(x).encode()
+    return b'%d' % x
 
 def encode_bool(b):
     if isinstance(b, bytes):
@@ -334,6 +407,10 @@ class p4client(object):
 
         # caches
         self.clientspec = {}
+        self.p4args = {}
+        self.hgranges = {}
+        self.findcache = {}
+        self.worker = threading.local()  # notes kept by pull look-ahead threads
         self.usercache = {}
         self.p4stat = None
         self.p4pending = None
@@ -342,6 +419,17 @@ class p4client(object):
         if b':' not in s:
             s = b'%s:1666' % s
         self.server = s
+
+        # p4 users are cached in the repository across commands, each with
+        # the time it was read from p4; the cache is keyed by the clientuser
+        # mapping in effect, which decides what a user becomes
+        now = time.time()
+        self.usersname = self.ui.config(b'perfarce', b'clientuser') or b''
+        self.users = dict((u, v) for u, v in (self.readcache(b'users', self.usersname) or {}).items()
+                          if isinstance(v, tuple) and 0 <= now - v[0] < self.cachettl)
+        self.usercache.update(((u, None), v[1]) for u, v in self.users.items())
+        self.usersdirty = False
+
         if c:
             if b'/' in c:
                 c, p = c.split(b'/', 1)
@@ -351,6 +439,12 @@ class p4client(object):
             else:
                 p = b''
 
+            if sys.platform.startswith("cygwin"):
+                def isdir(d):
+                    return os.path.isdir(d) and not _RE_DOSPATH.match(d)
+            else:
+                isdir=os.path.isdir
+
             d = self.runone(b'client -o %s' % shellquote(c), abort=False)
             if not isinstance(d, dict):
                 raise p4badclient(_(b'%s is not a valid p4 client') % path)
@@ -360,13 +454,6 @@ class p4client(object):
                 ui.warn('%s\n' % data)
                 raise p4badclient(_(b'%s is not a valid p4 client: %s') % (path, data))
 
-            if sys.platform.startswith("cygwin"):
-                re_dospath = re.compile('[a-z]:\\\\',re.I)
-                def isdir(d):
-                    return os.path.isdir(d) and not re_dospath.match(d)
-            else:
-                isdir=os.path.isdir
-
             for n in [b'Root'] + [b'AltRoots%d' % i for i in range(9)]:
                 if n in d and isdir(d[n]):
                     self.root = util.pconvert(d[n])
@@ -390,6 +477,47 @@ class p4client(object):
             if self.root.endswith(b'/'):
                 self.root = self.root[:-1]
 
+    @propertycache
+    def cachettl(self):
+        'number of seconds p4 client and user data is cached for'
+        try:
+            return self.ui.configint(b'perfarce', b'cachettl', 300)
+        except ConfigError:
+            return 300
+
+    @propertycache
+    def cachevfs(self):
+        if self.repo is None or isinstance(self.repo, p4repo) or self.cachettl <= 0:
+            return None
+        return self.repo.cachevfs
+
+    def cachename(self, kind, name):
+        'name of the cache file for p4 data of the given kind and name'
+        key = hashlib.sha1(b'%s/%s' % (self.server, name)).digest()
+        return b'perfarce-%s-%s' % (kind, hex(key))
+
+    def readcache(self, kind, name):
+        'return the cached p4 data, or None if missing or expired'
+        if self.cachevfs is None:
+            return None
+        try:
+            stamp, value = marshal.loads(self.cachevfs.read(self.cachename(kind, name)))
+        except Exception:
+            return None
+        if not 0 <= time.time() - stamp < self.cachettl:
+            return None
+        return value
+
+    def writecache(self, kind, name, value):
+        'store p4 data in the cache, the cache is optional so errors are ignored'
+        if self.cachevfs is None:
+            return
+        try:
+            self.cachevfs.write(self.cachename(kind, name),
+                                marshal.dumps((time.time(), value), 0), atomictemp=True)
+        except (IOError, OSError):
+            if self.ui.traceback:self.ui.traceback()
+
     def find(self, rev=None, base=False, p4rev=None, abort=True):
         '''Find the most recent revision which has the p4 extra data which
         gives the p4 changelist it was converted from. If base is True then
@@ -397,72 +525,83 @@ class p4client(object):
         between it and the p4 changelist are to .hg files.
         Returns the revision and p4 changelist number'''
 
+        if rev is None:
+            rev = revsymbol(self.repo, b'default')
+        current = self.repo[rev]
+
+        key = (current.node(), base, p4rev)
+        r = self.findcache.get(key)
+        if r is None:
+            r = self.findcache[key] = self._find(current, base, p4rev)
+        if r[0] == nullid and abort:
+            raise error.Abort(_(b'no p4 changelist revision found'))
+        return r
+
+    def _find(self, current, base, p4rev):
+        'search the ancestors of current for find'
+
+        hgonly = {}
         def dothgonly(ctx):
             'returns True if only .hg files in this context'
-
-            if not ctx.files():
+            node = ctx.node()
+            r = hgonly.get(node)
+            if r is None:
+                files = ctx.files()
                 # no files means this must have been a merge
-                return False
-
-            for f in ctx.files():
-                if not f.startswith(b'.hg'):
-                    return False
-            return True
+                r = hgonly[node] = bool(files) and all(f.startswith(b'.hg') for f in files)
+            return r
 
         try:
             mqnode = [self.repo[revsymbol(self.repo, b'qbase')].node()]
         except Exception:
             mqnode = None
 
-        if rev is None:
-            rev = revsymbol(self.repo, b'default')
-        current = self.repo[rev]
+        # revisions between qbase and the start are mq patches, everything
+        # searched is an ancestor of the start so one walk covers them all
+        if mqnode:
+            mqreachable = set(self.repo.changelog.nodesbetween(mqnode, [current.node()])[0])
+        else:
+            mqreachable = set()
 
-        current = [(current,())]
-        seen = set()
+        # breadth first search, remembering the child each revision was
+        # reached from so the path back to the start can be rebuilt
+        child = {current: None}
+        current = [current]
         while current:
             next_items = []
-            self.ui.debug(b"find: %s\n" % (b" ".join(hex(c[0].node()) for c in current)))
-            for ctx,path in current:
+            if self.ui.debugflag:
+                self.ui.debug(b"find: %s\n" % (b" ".join(hex(c.node()) for c in current)))
+            for ctx in current:
                 extra = ctx.extra()
                 if b'p4' in extra:
+                    p4 = int(extra[b'p4'])
                     if base:
-                        while path:
-                            if dothgonly(path[0]) and not (mqnode and
-                                   self.repo.changelog.nodesbetween(mqnode, [ctx.node()])[0]):
-                                ctx = path[0]
-                                path = path[1:]
+                        c = child[ctx]
+                        while c is not None:
+                            if dothgonly(c) and ctx.node() not in mqreachable:
+                                ctx = c
+                                c = child[c]
                             else:
-                                path = []
-                    p4 = int(extra[b'p4'])
+                                break
                     if not p4rev or p4==p4rev:
                         return ctx.node(), p4
 
                 for p in ctx.parents():
-                    if p and p not in seen:
-                        seen.add(p)
-                        next_items.append((p, (ctx,) + path))
+                    if p and p not in child:
+                        child[p] = ctx
+                        next_items.append(p)
 
             current = next_items
 
-        if abort:
-            raise error.Abort(_(b'no p4 changelist revision found'))
         return nullid, 0
 
-    @propertycache
-    def re_type(self): return re.compile(b'([a-z]+)?(text|binary|symlink|apple|resource|unicode|utf\d+)(\+\w+)?$')
-    @propertycache
-    def re_keywords(self): return re.compile(br'\$(Id|Header|Date|DateTime|Change|File|Revision|Author):[^$\n]*\$')
-    @propertycache
-    def re_keywords_old(self): return re.compile(b'\$(Id|Header):[^$\n]*\$')
-
     def decodetype(self, p4type):
         'decode p4 type name into mercurial mode string and keyword substitution regex'
 
         base = mode = b''
         keywords = None
         utf16 = False
-        p4type = self.re_type.match(p4type)
+        p4type = _RE_TYPE.match(p4type)
         if p4type:
             base = p4type.group(2)
             flags = (p4type.group(1) or b'') + (p4type.group(3) or b'')
@@ -473,9 +612,9 @@ class p4client(object):
             if base == b'utf16':
                 utf16 = True
             if b'ko' in flags:
-                keywords = self.re_keywords_old
+                keywords = _RE_KEYWORDS_OLD
             elif b'k' in flags:
-                keywords = self.re_keywords
+                keywords = _RE_KEYWORDS
         return base, mode, keywords, utf16
 
 
@@ -489,55 +628,135 @@ class p4client(object):
         e = os.environ.get("P4CHARSET")
         if e:
             return emap.get(e,e)
-        return self.ui.config(b'perfarce', b'encoding', None).decode()
+        e = self.ui.config(b'perfarce', b'encoding')
+        return e and pycompat.sysstr(e)
+
+    @propertycache
+    def recode(self):
+        'p4 and local character sets, or None if text needs no conversion'
+        if not self.encoding:
+            return None
+        local = pycompat.sysstr(encoding.encoding)
+        try:
+            if codecs.lookup(self.encoding).name == codecs.lookup(local).name:
+                return None
+        except LookupError as e:
+            raise error.Abort(b"%s, please check your locale settings" % pycompat.bytestr(e))
+        return self.encoding, local
 
     def decode(self, text):
         'decode text in p4 character set as utf-8'
-        if self.encoding:
-            try:
-                return text.decode(self.encoding).encode(str(encoding.encoding, encoding='ascii'))
-            except LookupError as e:
-                raise error.Abort("%s, please check your locale settings" % e)
+        recode = self.recode
+        if recode:
+            return text.decode(recode[0]).encode(recode[1])
         return text
 
     def encode(self, text):
         'encode utf-8 text to p4 character set'
-
-        if self.encoding:
-            try:
-                return text.decode(str(encoding.encoding, encoding='ascii')).encode(self.encoding)
-            except LookupError as e:
-                raise error.Abort("%s, please check your locale settings" % e)
+        recode = self.recode
+        if recode:
+            return text.decode(recode[1]).encode(recode[0])
         return text
 
 
     @staticmethod
+    @functools.lru_cache(maxsize=1<<16)
     def encodename(name):
         'escape @ # % * characters in a p4 filename'
         return name.replace(b'%',b'%25').replace(b'@',b'%40').replace(b'#',b'%23').replace(b'*',b'%2A')
 
 
     @staticmethod
+    def decodename(name):
+        'unescape @ # % * characters in a p4 filename'
+        return name.replace(b'%40',b'@').replace(b'%23',b'#').replace(b'%2A',b'*').replace(b'%25',b'%')
+
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1<<16)
     def normcase(name):
         'convert path name to lower case'
         return os.path.normpath(name).lower()
 
-    @propertycache
-    def re_hgid(self): return re.compile(b'{{mercurial (([0-9a-f]{40})(:([0-9a-f]{40}))?)}}')
-
     def parsenodes(self, desc):
         'find revisions in p4 changelist description'
-        m = self.re_hgid.search(desc)
+        if b'{{mercurial ' not in desc:
+            # most descriptions have no revisions, skip the regex
+            return [], None
+        m = _RE_HGID.search(desc)
         nodes = []
         if m:
-            try:
-                nodes = self.repo.changelog.nodesbetween(
-                    [self.repo[m.group(2)].node()], [self.repo[m.group(4) or m.group(2)].node()])[0]
-            except Exception:
-                if self.ui.traceback:self.ui.traceback()
-                self.ui.note(_(b'ignoring hg revision range %s from p4\n' % m.group(1)))
+            nodes = self.hgranges.get(m.group(1))
+            if nodes is None:
+                cl = self.repo.changelog
+                try:
+                    nodes = cl.nodesbetween([cl.node(cl.rev(bin(m.group(2))))],
+                                            [cl.node(cl.rev(bin(m.group(4) or m.group(2))))])[0]
+                except Exception:
+                    if self.ui.traceback:self.ui.traceback()
+                    self.ui.note(_(b'ignoring hg revision range %s from p4\n' % m.group(1)))
+                    nodes = []
+                self.hgranges[m.group(1)] = nodes
         return nodes, m
 
+    @propertycache
+    def pendinglimit(self):
+        'number of recent submitted changelists checked for pushed revisions'
+        try:
+            r = self.ui.configint(b'perfarce', b'pendinglimit', 200)
+        except ConfigError:
+            r = 200
+        return max(r, 1)
+
+    @propertycache
+    def parallel(self):
+        'number of threads used by p4 sync, 0 for the p4 default'
+        try:
+            return self.ui.configint(b'perfarce', b'parallel', 0)
+        except ConfigError:
+            return 0
+
+    @propertycache
+    def tcpsize(self):
+        'p4 network buffer size, 0 for the p4 default'
+        try:
+            return self.ui.configint(b'perfarce', b'tcpsize', 0)
+        except ConfigError:
+            return 0
+
+    @propertycache
+    def getfileparallel(self):
+        'number of files printed at the same time by pull'
+        try:
+            r = self.ui.configint(b'perfarce', b'getfile_parallel', 8)
+        except ConfigError:
+            r = 8
+        return min(max(r, 1), 32)
+
+    @propertycache
+    def pullprefetch(self):
+        'number of changelists pull reads ahead'
+        try:
+            return max(self.ui.configint(b'perfarce', b'pull_prefetch', 4), 0)
+        except ConfigError:
+            return 4
+
+    @propertycache
+    def pushparallel(self):
+        'number of files written at the same time by push'
+        try:
+            return max(self.ui.configint(b'perfarce', b'push_parallel', 8), 1)
+        except ConfigError:
+            return 8
+
+    @propertycache
+    def unshelveparallel(self):
+        'number of p4 changes commands run at the same time by p4unshelve'
+        try:
+            return max(self.ui.configint(b'perfarce', b'unshelve_parallel', 8), 1)
+        except ConfigError:
+            return 8
+
     @propertycache
     def maxargs(self):
         try:
@@ -552,18 +771,33 @@ class p4client(object):
         return r
 
 
-    def run(self, cmd, files=[], abort=True, client=None):
-        'Run a P4 command and yield the objects returned'
-        c = [b'p4', b'-G']
-        if self.server:
-            c.append(b'-p')
-            c.append(self.server)
-        if client or self.client:
-            c.append(b'-c')
-            c.append(client or self.client)
-        if self.root:
-            c.append(b'-d')
-            c.append(shellquote(self.root))
+    def run(self, cmd, files=[], abort=True, client=None, input=None, xargs=None):
+        '''Run a P4 command and yield the objects returned.
+        If input is given it is written to the standard input of p4.
+        If xargs is given its items are passed to p4 on standard input
+        with -x, in a single invocation. Items may be tuples, in which
+        case the command is run once per tuple using -b.'''
+        client = client or self.client
+        c = self.p4args.get(client)
+        if c is None:
+            c = [b'p4', b'-G']
+            if self.server:
+                c.append(b'-p')
+                c.append(self.server)
+            if client:
+                c.append(b'-c')
+                c.append(client)
+            if self.root:
+                c.append(b'-d')
+                c.append(shellquote(self.root))
+            if self.tcpsize > 0:
+                c.append(b'-v')
+                c.append(b'net.tcpsize=%d' % self.tcpsize)
+            c = b' '.join(c)
+            if self.root or not client:
+                # complete, the client root is known once there is a client
+                self.p4args[client] = c
+        c = [c]
 
         if files and len(files)>self.maxargs:
             tmp = TempFile('w')
@@ -575,22 +809,60 @@ class p4client(object):
             c.append(str.encode(tmp.Name))
             files = []
 
+        if xargs is not None:
+            batch = 0
+            lines = []
+            for a in xargs:
+                if isinstance(a, tuple):
+                    batch = len(a)
+                    lines.extend(a)
+                else:
+                    lines.append(a)
+            if self.ui.debugflag:
+                for a in lines:
+                    self.ui.debug(b'> -x %s\n' % a)
+            c.append(b'-x -')
+            if batch:
+                c.append(b'-b %d' % batch)
+            input = b''.join(a + b'\n' for a in lines)
+
         c.append(cmd)
+        c.extend(shellquote(f) for f in files)
 
-        cs = b' '.join(c + [shellquote(f) for f in files])
+        cs = b' '.join(c)
         if self.ui.debugflag: self.ui.debug(b'> %s\n' % cs)
 
-        for d in loaditer(popen(cs, b'rb')):
-            if self.ui.debugflag: self.ui.debug(b'< %r\n' % d)
-            code = d.get(b'code')
-            data = d.get(b'data')
-            if code is not None and data is not None:
-                data = data.strip()
-                if abort and code == b'error':
-                    raise error.Abort(b'p4: %s' % data)
-                elif code == b'info':
-                    self.ui.note(b'p4: %s\n' % data)
-            yield d
+        # run p4 directly rather than through popen, saving a shell per command
+        p = subprocess.Popen(p4argv(cs), bufsize=1<<20, stdout=subprocess.PIPE,
+                             stdin=None if input is None else subprocess.PIPE)
+        try:
+            if input is not None:
+                # written by a thread, so that p4 can answer a long list
+                # of -x arguments while it is still reading them
+                def write():
+                    try:
+                        p.stdin.write(input)
+                        p.stdin.close()
+                    except (IOError, OSError):
+                        pass    # p4 has exited, its errors follow on stdout
+                writer = threading.Thread(target=write)
+                writer.daemon = True
+                writer.start()
+
+            for d in loaditer(p.stdout):
+                if self.ui.debugflag: self.ui.debug(b'< %r\n' % d)
+                code = d.get(b'code')
+                data = d.get(b'data')
+                if code is not None and data is not None:
+                    data = data.strip()
+                    if abort and code == b'error':
+                        raise error.Abort(b'p4: %s' % data)
+                    elif code == b'info':
+                        self.note(b'p4: %s\n' % data)
+                yield d
+        finally:
+            p.stdout.close()
+            p.wait()
 
     def runs(self, cmd, **args):
         '''Run a P4 command, discarding any output (except errors)'''
@@ -611,12 +883,29 @@ class p4client(object):
         return value
 
 
+    def notes(self):
+        'list of the notes kept for the caller in this thread, or None'
+        return getattr(self.worker, 'notes', None)
+
+    def note(self, msg):
+        'ui.note, but kept for the caller when run by a pull look-ahead thread'
+        notes = self.notes()
+        if notes is None:
+            self.ui.note(msg)
+        elif self.ui.verbose:
+            notes.append(msg)
+
     def getpending(self, node):
         '''returns True if node is pending in p4 or has been submitted to p4'''
         if self.p4stat is None:
             self._readp4stat()
         return node.node() in self.p4stat
 
+    def invalidate(self):
+        'forget the pending and submitted changelists read from p4'
+        self.p4stat = None
+        self.findcache.clear()
+
     def getpendinglist(self):
         'return p4 submission state dictionary'
         if self.p4stat is None:
@@ -630,26 +919,30 @@ class p4client(object):
 
         p4rev, p4id = self.find(abort=False)
 
-        def helper(self,d,p4id):
+        if self.partial:
+            change = b'%s...@%d,#head' % (self.partial, p4id)
+            changes = list(self.run(b'changes -l -c %s %s' %
+                                    (shellquote(self.client), shellquote(change))))
+        else:
+            # a revision range stops p4 from using its index of changes
+            # by client, so ask for the most recent ones and filter here
+            changes = [d for d in self.run(b'changes -l -s submitted -m %d -c %s' %
+                                           (self.pendinglimit, shellquote(self.client)))
+                       if int(d[b'change']) >= p4id]
+        changes.extend(self.run(b'changes -l -c %s -s pending' %
+                                (shellquote(self.client))))
+
+        pending = self.p4pending
+        for d in changes:
             c = int(d[b'change'])
             if c == p4id:
-                return
+                continue
 
             desc = d[b'desc']
             nodes, match = self.parsenodes(desc)
-            entry = (c, d[b'status'] == b'submitted', nodes, desc, d[b'client'])
-            self.p4pending.append(entry)
-            for n in nodes:
-                self.p4stat.add(n)
-
-        change = b'%s...@%d,#head' % (self.partial, p4id)
-        for d in self.run(b'changes -l -c %s %s' %
-                           (shellquote(self.client), shellquote(change))):
-            helper(self,d,p4id)
-        for d in self.run(b'changes -l -c %s -s pending' %
-                           (shellquote(self.client))):
-            helper(self,d,p4id)
-        self.p4pending.sort()
+            pending.append((c, d[b'status'] == b'submitted', nodes, desc, d[b'client']))
+        pending.sort()
+        self.p4stat.update(itertools.chain.from_iterable(e[2] for e in pending))
 
 
     def repopath(self, path):
@@ -659,17 +952,34 @@ class p4client(object):
             path = os.path.join(self.normcase(pathname), fname)
 
         path = util.pconvert(path)
-        #print(path, self.rootpart, file=sys.stderr)
-        if not path.startswith(self.rootpart):
+        rootpart = self.rootpart
+        if not path.startswith(rootpart):
             raise error.Abort(_(b'invalid p4 local path %s') % path)
 
-        return path[len(self.rootpart):]
+        return path[len(rootpart):]
 
     def localpath(self, path):
         'Convert a path relative to the hg root to a path in the p4 workarea'
-        return util.localpath(os.path.join(self.rootpart, path))
+        return self.localrootpart + util.localpath(path)
+
+    @propertycache
+    def localrootpart(self):
+        'rootpart with local path separators'
+        return util.localpath(self.rootpart)
 
 
+    @propertycache
+    def clientuser(self):
+        '''mapping of client names to user names set by perfarce.clientuser,
+        either a compiled regex and replacement, or a script name, or None'''
+        cu = self.ui.config(b"perfarce",b"clientuser")
+        if not cu:
+            return None
+        if b" " in cu:
+            cus, cur = cu.split(b" ", 1)
+            return re.compile(cus), cur
+        return util.expandpath(cu)
+
     def getuser(self, user, client=None):
         'get full name and email address of user (and optionally client spec name)'
         r = self.usercache.get((user,None)) or self.usercache.get((user,client))
@@ -677,18 +987,17 @@ class p4client(object):
             return r
 
         # allow mapping the client name into a user name
-        cu = self.ui.config(b"perfarce",b"clientuser")
+        cu = self.clientuser
 
-        if cu and b" " in cu:
-            cus, cur = cu.split(b" ", 1)
-            u, f = re.subn(cus, cur, client)
+        if isinstance(cu, tuple):
+            u, f = cu[0].subn(cu[1], client)
             if f:
-                r = string.capwords(u)
+                r = b' '.join(w.capitalize() for w in u.split())
                 self.usercache[(user, client)] = r
                 return r
 
         elif cu:
-            cmd = b"%s %s %s" % (util.expandpath(cu), shellquote(client), shellquote(user))
+            cmd = b"%s %s %s" % (cu, shellquote(client), shellquote(user))
             self.ui.debug(b'> %s\n' % cmd)
 
             old = os.getcwd()
@@ -710,6 +1019,11 @@ class p4client(object):
                 try:
                     r = b'%s <%s>' % (d[b'FullName'], d[b'Email'])
                     self.usercache[(user, None)] = r
+                    if not self.usersdirty:
+                        # written once when the command ends
+                        self.usersdirty = True
+                        self.ui.atexit(self.writecache, b'users', self.usersname, self.users)
+                    self.users[user] = (time.time(), r)
                     return r
                 except Exception:
                     pass
@@ -717,16 +1031,13 @@ class p4client(object):
         return user
 
 
-    @propertycache
-    def re_changeno(self): return re.compile(b'Change ([0-9]+) created.+')
-
     def change(self, change=None, description=None, update=False, jobs=None):
         '''Create a new p4 changelist or update an existing changelist with
         the given description. Returns the changelist number as a string.'''
 
         # get changelist data, and update it
         if isinstance(change, int) or isinstance(change, str):
-            changelist = self.runone(b'change -o %s' % (str(change).encode('ascii')))
+            changelist = self.runone(b'change -o %d' % int(change))
         if isinstance(change, bytes):
             changelist = self.runone(b'change -o %s' % change)
         if change is None:
@@ -739,19 +1050,15 @@ class p4client(object):
         if description is not None:
             changelist[b'Description'] = self.encode(description)
 
-        # write changelist data to a temporary file
-        tmp = TempFile('wb')
-        marshal.dump(changelist, tmp.File, 0)
-        tmp.close()
-
         # update p4 changelist
-        d = self.runone(b'change -i%s <%s' % (update and b" -u" or b"", shellquote(tmp.Name.encode('utf-8'))))
+        d = self.runone(b'change -i%s' % (update and b" -u" or b""),
+                        input=marshal.dumps(changelist, 0))
         data = d[b'data']
         if d[b'code'] == b'info':
             if not self.ui.verbose:
                 self.ui.status(b'p4: %s\n' % data)
             if not change:
-                m = self.re_changeno.match(data)
+                m = _RE_CHANGENO.match(data)
                 if m:
                     change = m.group(1)
         else:
@@ -760,8 +1067,7 @@ class p4client(object):
         if not change:
             raise error.Abort(_(b'did not get changelist number from p4'))
 
-        # invalidate cache
-        self.p4stat = None
+        self.invalidate()
 
         return change
 
@@ -779,6 +1085,13 @@ class p4client(object):
                 b'delete':b'R', b'move/delete':b'R', b'purge':b'R',
               }
 
+    def action(self, ac):
+        'Return the hg status letter of a p4 file action'
+        try:
+            return self.actions[ac]
+        except KeyError:
+            raise error.Abort(_(b'unknown p4 file action %s') % ac)
+
     def describe(self, change, local=None, shelve=False):
         '''Return p4 changelist description object with user name and date.
         If the local is true, then also collect a list of 5-tuples
@@ -789,49 +1102,66 @@ class p4client(object):
         so when this is used on pending changelists.
         '''
 
-        d = self.runone(b'describe -%s %s' % (b"S" if shelve else b"s", int_to_bytes(change)))
-        client = d[b'client']
-        status = d[b'status']
-        r = self.description(change=d[b'change'],
-                             desc=self.decode(d[b'desc']),
-                             user=self.getuser(self.decode(d[b'user']), client),
-                             date=(int(d[b'time']), 0),     # p4 uses UNIX epoch
-                             status=status,
-                             client=client)
-
-        files = {}
-        if local and status=='submitted':
-            r.files = self.fstat(change)
-        else:
-            r.files = []
-            i = 0
-            while True:
-                df = b'depotFile%d' % i
-                if df not in d:
-                    break
-                df = d[df]
-                rv = d[b'rev%d' % i]
-                tp = d[b'type%d' % i]
-                ac = d[b'action%d' % i]
-                files[df] = item = (df, int(rv), tp, self.actions[ac])
-                r.files.append(item)
-                i += 1
-
-        r.jobs = []
-        i = 0
-        while True:
-            jn = b'job%d' % i
-            if jn not in d:
-                break
-            r.jobs.append(d[jn])
-            i += 1
+        return self.describe_many([change], local=local, shelve=shelve)[0]
 
-        if local and files:
-            r.files = []
-            for d in self.run(b'where', files=[f for f in files]):
-                r.files.append(files[d[b'depotFile']] + (self.repopath(d[b'path']),))
 
-        return r
+    def describe_many(self, changes, local=None, shelve=False):
+        '''Return a list of p4 changelist description objects, one for each
+        of the given changes and in the same order, see describe.
+        All changes are described by a single p4 describe, and if local is
+        true the local filenames are found by a single p4 where.'''
+
+        if not changes:
+            return []
+
+        result = {}
+        where = []      # descriptions still needing local filenames
+        action = self.action
+        for d in self.run(b'describe -%s' % (b"S" if shelve else b"s"),
+                          files=[int_to_bytes(c) for c in changes]):
+            if b'change' not in d:
+                continue
+            change = int(d[b'change'])
+            client = d[b'client']
+            status = d[b'status']
+            r = self.description(change=d[b'change'],
+                                 desc=self.decode(d[b'desc']),
+                                 user=self.getuser(self.decode(d[b'user']), client),
+                                 date=(int(d[b'time']), 0),     # p4 uses UNIX epoch
+                                 status=status,
+                                 client=client)
+
+            if local and status=='submitted':
+                r.files = self.fstat(change)
+            else:
+                r.files = files = []
+                i = 0
+                while True:
+                    df = d.get(b'depotFile%d' % i)
+                    if df is None:
+                        break
+                    files.append((df, int(d[b'rev%d' % i]), d[b'type%d' % i],
+                                  action(d[b'action%d' % i])))
+                    i += 1
+                if local and files:
+                    where.append(r)
+
+            r.jobs = numbered(d, b'job')
+
+            result[change] = r
+
+        if where:
+            paths = {}
+            files = set(f[0] for r in where for f in r.files)
+            for d in self.run(b'where', files=sorted(files)):
+                paths.setdefault(d[b'depotFile'], []).append(self.repopath(d[b'path']))
+            for r in where:
+                r.files = [f + (p,) for f in r.files for p in paths.get(f[0], [])]
+
+        try:
+            return [result[int(c)] for c in changes]
+        except KeyError as e:
+            raise error.Abort(_(b'p4 describe returned no change %d') % e.args[0])
 
 
     def fstat(self, change=None, all=False, files=[]):
@@ -842,31 +1172,32 @@ class p4client(object):
         If all is unset considers only files modified by the
         changelist, otherwise returns all files *at* that changelist.
         '''
-        result = []
 
+        # p4 only sends the fields used here
+        p4cmd = b'fstat -T depotFile,clientFile,headRev,headType,headAction,desc'
         if files:
-            p4cmd = b'fstat'
+            pass    # passed to p4 by run
         elif all:
-            p4cmd = b'fstat %s' % shellquote(b'%s...@%d' % (self.partial, change))
+            p4cmd += b' ' + shellquote(b'%s...@%d' % (self.partial, change))
         else:
-            p4cmd = b'fstat -e %d %s' % (change, shellquote(b'%s...' % self.partial))
+            p4cmd += b' -e %d %s' % (change, shellquote(b'%s...' % self.partial))
 
-        progress = _makeprogress(self.ui, b'p4 fstat', unit=b'entries', total=len(files))
-        for d in self.run(p4cmd, files=files):
-            if b'desc' in d:
-                continue
-            progress.increment(item=d[b'depotFile'])
-            if d[b'clientFile'].startswith(b'.hg'):
-                continue
-            lf = self.repopath(d[b'clientFile'])
-            df = d[b'depotFile']
-            rv = d.get(b'headRev', 0)
-            tp = d.get(b'headType', b'')
-            ac = d.get(b'headAction', b'add')
-            result.append((df, int(rv), tp, self.actions[ac], lf))
+        # no progress bar from the pull look-ahead threads
+        progress = self.notes() is None and self.ui.makeprogress(b'p4 fstat', unit=b'entries', total=len(files))
+        def entries():
+            for d in self.run(p4cmd, files=files):
+                if b'desc' not in d:
+                    if progress: progress.increment(item=d[b'depotFile'])
+                    yield d
 
-        progress.complete()
-        self.ui.note(_(b'%d files \n') % len(result))
+        action = self.action
+        repopath = self.repopath
+        result = [(d[b'depotFile'], int(d.get(b'headRev', 0)), d.get(b'headType', b''),
+                   action(d.get(b'headAction', b'add')), repopath(d[b'clientFile']))
+                  for d in entries() if not d[b'clientFile'].startswith(b'.hg')]
+
+        if progress: progress.complete()
+        self.note(_(b'%d files \n') % len(result))
 
         return result
 
@@ -883,10 +1214,13 @@ class p4client(object):
         elif force:
             cmd += b' -f'
         if not files:
+            # p4 splits the work between threads itself, not for lists of files
+            if self.parallel > 0 and not fake:
+                cmd += b' --parallel threads=%d,min=1,minsize=1' % self.parallel
             cmd += b' ' + shellquote(b'%s...@%d' % (self.partial, change))
 
         n = 0
-        progress = _makeprogress(self.ui, b'p4 sync', unit=b'files')
+        progress = self.ui.makeprogress(b'p4 sync', unit=b'files')
         for d in self.run(cmd, files=[(b"%s@%d" % (os.path.join(self.partial, f), change)) for f in files], abort=False):
             n += 1
             progress.increment()
@@ -922,11 +1256,13 @@ class p4client(object):
                     try:
                         contents = os.readlink(fn)
                     except AttributeError:
-                        contents = file(fn, 'rb').read()
-                        if contents.endswith('\n'):
+                        with open(fn, 'rb') as f:
+                            contents = f.read()
+                        if contents.endswith(b'\n'):
                             contents = contents[:-1]
                 else:
-                    contents = file(fn, 'rb').read()
+                    with open(fn, 'rb') as f:
+                        contents = f.read()
             else:
                 cmd = b'print'
                 if utf16:
@@ -935,22 +1271,25 @@ class p4client(object):
                     cmd += b' -o %s'%shellquote(tmp.Name)
                 cmd += b' %s#%d' % (shellquote(entry[0]), entry[1])
 
-                contents = []
+                # collect the data in place rather than joining a list of
+                # chunks, which needs twice the memory of the file
+                buf = io.BytesIO()
                 for d in self.run(cmd):
                     code = d[b'code']
                     if code == b'text' or code == b'binary':
-                        contents.append(d[b'data'])
+                        buf.write(d[b'data'])
 
                 if utf16:
-                    contents = file(tmp.Name, 'rb').read()
+                    with open(tmp.Name, 'rb') as f:
+                        contents = f.read()
                 else:
-                    contents = b''.join(contents)
+                    contents = buf.getvalue()
 
-                if mode == b'l' and contents.endswith('\n'):
+                if mode == b'l' and contents.endswith(b'\n'):
                     contents = contents[:-1]
 
             if keywords:
-                contents = keywords.sub('$\\1$', contents)
+                contents = keywords.sub(b'$\\1$', contents)
 
             return mode, contents
         except Exception as e:
@@ -958,6 +1297,58 @@ class p4client(object):
             raise error.Abort(_(b'file %s missing in p4 workspace') % entry[4])
 
 
+    def getfiles(self, entries):
+        '''Return contents of several files in the p4 depot using a single p4 print.
+        Entries are tuples as for getfile, returns a dictionary of
+            (depotname, revision) : (mode, contents)
+        Deleted, utf16 and missing files are left out, use getfile for those.
+        If self.keep is set, reads the files in the client instead.
+        '''
+
+        if self.keep:
+            result = {}
+            for e in entries:
+                try:
+                    result[(e[0], e[1])] = self.getfile(e)
+                except error.Abort:
+                    pass
+            return result
+
+        types = {}
+        for e in entries:
+            if e[3] != b'R':
+                basetype, mode, keywords, utf16 = self.decodetype(e[2])
+                if not utf16:
+                    types[(e[0], e[1])] = mode, keywords
+
+        # p4 prints a stat object for each file followed by its contents
+        bufs = {}
+        buf = None
+        if types:
+            for d in self.run(b'print', files=[b'%s#%d' % k for k in sorted(types)], abort=False):
+                code = d.get(b'code')
+                if code == b'stat':
+                    buf = bufs.setdefault((d[b'depotFile'], int(d[b'rev'])), io.BytesIO())
+                elif code == b'text' or code == b'binary':
+                    if buf is not None:
+                        buf.write(d[b'data'])
+                else:
+                    buf = None
+
+        result = {}
+        for k, buf in bufs.items():
+            if k not in types:
+                continue
+            mode, keywords = types[k]
+            contents = buf.getvalue()
+            if mode == b'l' and contents.endswith(b'\n'):
+                contents = contents[:-1]
+            if keywords:
+                contents = keywords.sub(b'$\\1$', contents)
+            result[k] = mode, contents
+        return result
+
+
     @propertycache
     def tags(self):
         try:
@@ -971,15 +1362,12 @@ class p4client(object):
     def labels(self, change):
         'Return p4 labels a.k.a. tags at the given changelist'
 
-        tags = []
-        if self.tags:
-            change = b'%s...@%d,%d' % (self.partial, change, change)
-            for d in self.run(b'labels %s' % shellquote(change)):
-                l = d.get(b'label')
-                if l:
-                    tags.append(l)
+        if not self.tags:
+            return []
 
-        return tags
+        change = b'%s...@%d,%d' % (self.partial, change, change)
+        return [d[b'label'] for d in self.run(b'labels %s' % shellquote(change))
+                if d.get(b'label')]
 
 
     def submit(self, change):
@@ -998,8 +1386,7 @@ class p4client(object):
             # delete the files in the p4 client directory
             self.sync(0)
 
-        # invalidate cache
-        self.p4stat = None
+        self.invalidate()
 
 
     def hasmovecopy(self):
@@ -1009,11 +1396,14 @@ class p4client(object):
         mc = []
         for op in b'move',b'copy':
             v = self.ui.configbool(b'perfarce', op, None)
+            if v is None:
+                v = self.readcache(b'help', op)
             if v is None:
                 self.ui.note(_(b'checking if p4 %s is supported, set perfarce.%s to skip this test\n') % (op, op))
                 d = self.runone(b'help %s' % op, abort=False)
                 v = d[b'code']==b'info'
                 self.ui.debug(_(b'p4 %s is %ssupported\n') % (op, [b"not ",b""][v]))
+                self.writecache(b'help', op, v)
             mc.append(v)
 
         return tuple(mc)
@@ -1139,27 +1529,25 @@ def _pushcommon(ui, repo, client, opts):
         ui.status(_(b'no changes found\n'))
         return None
 
-    # find changed files
+    # find changed files, except .hg* files (mainly for .hgtags and .hgignore)
     mod, add, rem = tuple(repo.status(node1=ctx1.node(), node2=ctx2.node()))[:3]
-    mod = [(f, ctx2.flags(f)) for f in mod]
-    add = [(f, ctx2.flags(f)) for f in add]
-    rem = [(f, b"") for f in rem]
+    flags1 = ctx1.manifest().flags
+    flags2 = ctx2.manifest().flags
+    mod = [(f, flags2(f)) for f in mod if not f.startswith(b'.hg')]
+    add = [(f, flags2(f)) for f in add if not f.startswith(b'.hg')]
+    rem = [(f, b"") for f in rem if not f.startswith(b'.hg')]
 
     cpy = copies.pathcopies(ctx1, ctx2)
     # remember which copies change the data
+    data1 = {}
     for c in cpy:
-        chg = ctx2.flags(c) != ctx1.flags(c) or ctx2[c].data() != ctx1[cpy[c]].data()
-        cpy[c] = (cpy[c], chg)
-
-    # remove .hg* files (mainly for .hgtags and .hgignore)
-    for changes in [mod, add, rem]:
-        i = 0
-        while i < len(changes):
-            f = changes[i][0]
-            if f.startswith(b'.hg'):
-                del changes[i]
-            else:
-                i += 1
+        src = cpy[c]
+        chg = flags2(c) != flags1(c)
+        if not chg:
+            if src not in data1:
+                data1[src] = ctx1[src].data()
+            chg = ctx2[c].data() != data1[src]
+        cpy[c] = (src, chg)
 
     if not (mod or add or rem):
         ui.status(_(b'no changes found\n'))
@@ -1179,17 +1567,13 @@ def _pushcommon(ui, repo, client, opts):
         pass
 
     # create description
-    desc = []
-    for n in nodes:
-        desc.append(repo[n].description())
-
     if len(nodes) > 1:
-        h = [repo[nodes[0]].hex()]
+        h = b'%s:%s' % (hex(nodes[0]), hex(nodes[-1]))
     else:
-        h = []
-    h.append(repo[nodes[-1]].hex())
+        h = hex(nodes[-1])
 
-    desc=b'\n* * *\n'.join(desc) + b'\n\n{{mercurial %s}}\n' % (b':'.join(h))
+    desc = b''.join([b'\n* * *\n'.join(repo[n].description() for n in nodes),
+                     b'\n\n{{mercurial ', h, b'}}\n'])
 
     if ui.debugflag:
         ui.debug(b'mod = %r\n' % (mod,))
@@ -1220,35 +1604,39 @@ def incoming(original, ui, repo, source=None, **opts):
 
     limit = opts[b'limit']
     limit = limit and int(limit) or 0
+    if limit > 0:
+        changes = changes[:limit]
 
-    for c in changes:
-        cl = client.describe(c, local=ui.verbose)
+    for c, cl in zip(changes, client.describe_many(changes, local=ui.verbose)):
         tags = client.labels(c)
 
-        ui.write(_(b'changelist:  %d\n') % c)
+        # one write per changelist, unless debug output may come in between
+        out = []
+        write = ui.write if ui.debugflag else out.append
+
+        write(_(b'changelist:  %d\n') % c)
         # ui.write(_(b'branch:      %s\n') % branch)
         for tag in tags:
-            ui.write(_(b'tag:         %s\n') % tag)
+            write(_(b'tag:         %s\n') % tag)
         # ui.write(_(b'parent:      %d:%s\n') % parent)
-        ui.write(_(b'user:        %s\n') % cl.user)
-        ui.write(_(b'date:        %s\n') % datestr(cl.date))
+        write(_(b'user:        %s\n') % cl.user)
+        write(_(b'date:        %s\n') % datestr(cl.date))
         if cl.jobs:
-            ui.write(_(b'jobs:        %s\n') % b' '.join(cl.jobs))
+            write(_(b'jobs:        %s\n') % b' '.join(cl.jobs))
         if ui.verbose:
-            ui.write(_(b'files:       %s\n') % b' '.join(f[4] for f in cl.files))
+            write(_(b'files:       %s\n') % b' '.join(f[4] for f in cl.files))
 
         if cl.desc:
             if ui.verbose:
-                ui.write(_(b'description:\n'))
-                ui.write(cl.desc)
-                ui.write(b'\n')
+                write(_(b'description:\n'))
+                write(cl.desc)
+                write(b'\n')
             else:
-                ui.write(_(b'summary:     %s\n') % cl.desc.splitlines()[0])
+                write(_(b'summary:     %s\n') % cl.desc.splitlines()[0])
 
-        ui.write(b'\n')
-        limit-=1
-        if limit==0:
-            break
+        write(b'\n')
+        if out:
+            ui.write(b''.join(out))
 
     return 0  # exit code is zero since we found incoming changes
 
@@ -1266,7 +1654,7 @@ def pull(original, ui, repo, source=None, **opts):
 
     # for clone we support an --encoding option to set server character set
     if opts.get(b'encoding'):
-        client.encoding = opts.get(b'encoding')
+        client.encoding = pycompat.sysstr(opts.get(b'encoding'))
 
     # for clone we support a --startrev option to fold initial changelists
     startrev = opts.get(b'startrev')
@@ -1295,23 +1683,35 @@ def pull(original, ui, repo, source=None, **opts):
 
     ctx = None
     first_ctx = None
+    manifiles = None
     tags = {}
     trim = ui.configbool(b'perfarce', b'pull_trim_log', False)
 
-    progress = _makeprogress(ui, topic=_(b'pulling changes'), unit=_(b'changes'), total=len(changes))
+    # get the files of each changelist in batches, several at a time, and
+    # unless they are read from the workspace, ahead of the commits
+    pool = futures.ThreadPoolExecutor(client.getfileparallel)
+    batches = _pull_batches(client, changes, all=bool(startrev),
+                            pool=None if client.keep else pool)
+
+    progress = ui.makeprogress(_(b'pulling changes'), unit=_(b'changes'), total=len(changes))
+    prefetched = None
     try:
-        for c in changes:
+        for c, cl, files, labels, prefetched, notes in batches:
             ui.note(_(b'change %s\n') % int_to_bytes(c))
-            cl = client.describe(c)
-            files = client.fstat(c, all=bool(startrev))
+            for n in notes:
+                ui.note(n)
 
             if client.keep:
                 if startrev:
                     client.sync(c, all=True, force=True)
                 else:
-                    client.runs(b'revert -k', files=[f[0] for f in files], abort=False)
-                    client.sync(c, force=True, files=[f[0] for f in files if f[3]==b"R"]+
-                                                     [f[0] for f in files if f[3]!=b"R"])
+                    # deletes first, then the other files
+                    removed, other = [], []
+                    for f in files:
+                        (removed if f[3]==b"R" else other).append(f[0])
+                    depot = removed + other
+                    client.runs(b'revert -k', files=depot, abort=False)
+                    client.sync(c, force=True, files=depot)
 
             nodes, match = client.parsenodes(cl.desc)
             if nodes:
@@ -1335,24 +1735,39 @@ def pull(original, ui, repo, source=None, **opts):
             else:
                 extra = {b'p4': int_to_bytes(c)}
 
-            entries = _entries(repo, files, client, p1=p4rev, p2=parent)
-            getfilectx = _get_getfilectx(entries, client, p2=parent)
+            if client.ignorecase and manifiles is None:
+                manifiles = _manifiles(repo, client, p4rev)
+            entries, deleted = _entries(repo, files, client, p1=p4rev, p2=parent,
+                                        manifiles=manifiles)
+            if client.keep:
+                # the workspace files can only be read once synced
+                prefetched = _prefetch(pool, client, files)
+            getfilectx = _get_getfilectx(entries, deleted, client, p2=parent,
+                                         prefetched=prefetched)
             ctx = _common_commit(cl, repo, getfilectx, extra,
                                  files=list(entries.keys()) + hgfiles,
                                  p1=p4rev, p2=parent)
             p4rev = ctx.hex()
             if first_ctx is None:
                 first_ctx = ctx
+            if manifiles is not None:
+                # the new revision is its first parent plus its own files
+                _updatemanifiles(manifiles, client, ctx)
 
-            for l in client.labels(c):
+            for l in labels:
                 tags[l] = (c, ctx.hex())
 
             repo.pushkey(b'phases', ctx.hex(), str(phases.draft), str(phases.public))
 
             ui.note(_(b'added changeset %d:%s\n') % (ctx.rev(), ctx))
-            progress.increment(item=str(c).encode('ascii'))
+            progress.increment(item=b'%d' % c)
 
     finally:
+        batches.close()
+        # on errors do not wait for the files of the current change
+        for f in (prefetched or {}).values():
+            f.cancel()
+        pool.shutdown()
         if tags:
             tag_ctx = _commit_tags(repo, client, tags)
             p4rev = tag_ctx.hex()
@@ -1374,6 +1789,61 @@ def pull(original, ui, repo, source=None, **opts):
     return commands.postincoming(ui, repo, 1, opts.get(b'update'), p4rev, None)
 
 
+def _describe_batches(client, changes):
+    'Yield (change, description) pairs, describing up to maxargs changes at a time'
+    for i in range(0, len(changes), client.maxargs):
+        batch = changes[i:i + client.maxargs]
+        for c, cl in zip(batch, client.describe_many(batch)):
+            yield c, cl
+
+
+def _pull_batches(client, changes, all=False, pool=None):
+    '''Yield (change, description, files, labels, prefetched, notes) tuples,
+    reading the files and labels of the next perfarce.pull_prefetch changes
+    in the background. If pool is given the file contents are also
+    prefetched on it. The all option is passed to fstat for the first change
+    only. The notes of the background work are returned for the caller to
+    write, so that they are in the order of the changes.'''
+    def fetch(c, all):
+        client.worker.notes = notes = []
+        try:
+            files = client.fstat(c, all=all)
+            labels = client.tags and client.labels(c) or []
+        finally:
+            client.worker.notes = None
+        return files, labels, pool and _prefetch(pool, client, files), notes
+
+    if not client.pullprefetch or client.ui.debugflag:
+        # the debug output of p4 commands is written as they run
+        for c, cl in _describe_batches(client, changes):
+            yield (c, cl) + fetch(c, all)
+            all = False
+        return
+
+    ahead = futures.ThreadPoolExecutor(client.pullprefetch)
+    window = collections.deque()
+    try:
+        for c, cl in _describe_batches(client, changes):
+            window.append((c, cl, ahead.submit(fetch, c, all)))
+            all = False
+            if len(window) > client.pullprefetch:
+                c, cl, f = window.popleft()
+                yield (c, cl) + f.result()
+        while window:
+            c, cl, f = window.popleft()
+            yield (c, cl) + f.result()
+    finally:
+        for c, cl, f in window:
+            f.cancel()
+        # wait for the running look-ahead, then cancel the file prints it
+        # queued, so that an interrupted pull does not wait for them
+        ahead.shutdown()
+        for c, cl, f in window:
+            if not f.cancelled() and f.exception() is None:
+                for p in (f.result()[2] or {}).values():
+                    p.cancel()
+
+
 def _commit_tags(repo, client, tags):
     p4rev, p4id = client.find()
     ctx = repo[p4rev]
@@ -1383,11 +1853,10 @@ def _commit_tags(repo, client, tags):
     else:
         tagdata = []
 
-    desc = [b'p4 tags']
-    for l in sorted(tags):
-        t = tags[l]
-        desc.append(b'   %s @ %d' % (l, t[0]))
-        tagdata.append(b'%s %s\n' % (t[1], l))
+    labels = sorted(tags)
+    desc = b'\n'.join([b'p4 tags'] + [b'   %s @ %d' % (l, tags[l][0]) for l in labels])
+    tagdata.extend(b'%s %s\n' % (tags[l][1], l) for l in labels)
+    tagdata = b''.join(tagdata)
 
     def getfilectx(repo, memctx, fn):
         'callback to read file data'
@@ -1396,55 +1865,34 @@ def _commit_tags(repo, client, tags):
             changectx=None,
             repo=repo,
             path=fn,
-            data=b''.join(tagdata),
+            data=tagdata,
             islink=False,
             isexec=False,
         )
-    ctx = context.memctx(repo, (p4rev, None), b'\n'.join(desc),
+    ctx = context.memctx(repo, (p4rev, None), desc,
                             [b'.hgtags'], getfilectx)
     p4rev = repo.commitctx(ctx)
     return repo[p4rev]
 
 
-def _makeprogress(ui, topic, unit="", total=None):
-    try:
-        return ui.makeprogress(topic, unit=unit, total=total)
-    except AttributeError:
-        # Mercurial 4.6.2 and older
-        class Progress:
-            def __init__(self, ui, topic, unit, total):
-                self.ui = ui
-                self.topic = topic
-                self.unit = unit
-                self.total = total
-                self.pos = 0
-                self._progress()
-
-            def _progress(self, item=""):
-                self.ui.progress(self.topic, self.pos, item=item, unit=self.unit, total=self.total)
-
-            def increment(self, item=""):
-                self.pos += 1
-                self._progress(item)
-
-            def complete(self):
-                self.pos = None
-                self._progress()
-        return Progress(ui, _(b'pulling changes'), unit=_(b'changes'), total=total)
-
-
-def _get_getfilectx(entries, client, p2=None):
+def _get_getfilectx(entries, deleted, client, p2=None, prefetched=None):
     def getfilectx(repo, memctx, fn):
         'callback to read file data'
         if fn.startswith(b'.hg'):
             return repo[p2].filectx(fn)
 
-        if entries[fn][3] == b'R' and getattr(memctx, '_returnnoneformissingfiles', False):
+        if fn in deleted:
             # from 3.1 onvards, ctx expects None for deleted files
-            client.ui.debug(b'removed file %r\n'%(entries[fn],))
+            if client.ui.debugflag:
+                client.ui.debug(b'removed file %r\n'%(entries[fn],))
             return None
 
-        mode, contents = client.getfile(entries[fn])
+        entry = entries[fn]
+        f = prefetched and prefetched.pop(entry[:2], None)
+        r = f and f.result().get(entry[:2])
+        if r is None:
+            r = client.getfile(entry)
+        mode, contents = r
         if contents is None:
             return None
         return context.memfilectx(
@@ -1458,14 +1906,45 @@ def _get_getfilectx(entries, client, p2=None):
     return getfilectx
 
 
-def _entries(repo, files, client, p1, p2=None):
+def _prefetch(pool, client, files):
+    '''Start getting the files of a changelist in batches, returns futures
+    by (depotname, revision)'''
+    files = [f for f in files if f[3] != b'R']
+    size = min(max(-(-len(files) // client.getfileparallel), 1), client.maxargs)
+    prefetched = {}
+    for i in range(0, len(files), size):
+        batch = files[i:i + size]
+        f = pool.submit(client.getfiles, batch)
+        for e in batch:
+            prefetched[e[:2]] = f
+    return prefetched
+
+
+def _manifiles(repo, client, node):
+    'Map the case normalized names of the files in a revision to the file names'
+    normcase = client.normcase
+    return dict((normcase(f), f) for f in repo[node])
+
+
+def _updatemanifiles(manifiles, client, ctx):
+    'Update the map of case normalized names from the first parent of ctx to ctx'
+    normcase = client.normcase
+    for f in ctx.files():
+        g = normcase(f)
+        if f in ctx:
+            manifiles[g] = f
+        elif manifiles.get(g) == f:
+            del manifiles[g]
+
+
+def _entries(repo, files, client, p1, p2=None, manifiles=None):
     entries = {}
     if client.ignorecase:
-        manifiles = {}
-        for n in (p1, p2):
-            if n:
-                for f in repo[n]:
-                    manifiles[client.normcase(f)] = f
+        if manifiles is None:
+            manifiles = _manifiles(repo, client, p1)
+        if p2:
+            manifiles = dict(manifiles)
+            manifiles.update(_manifiles(repo, client, p2))
         seen = set()
         for f in files:
             g = client.normcase(f[4])
@@ -1474,7 +1953,8 @@ def _entries(repo, files, client, p1, p2=None):
                 seen.add(g)
     else:
         entries.update((f[4], f) for f in files)
-    return entries
+    deleted = set(fn for fn, f in entries.items() if f[3] == b'R')
+    return entries, deleted
 
 
 def _common_commit(cl, repo, getfilectx, extra, files, p1, p2=None):
@@ -1542,6 +2022,10 @@ def clone(original, ui, source, dest=None, **opts):
         fp.write(b"keep = %s\n" % encode_bool(client.keep))
         fp.write(b"lowercasepaths = %s\n" % encode_bool(client.lowercasepaths))
         fp.write(b"tags = %s\n" % encode_bool(client.tags))
+        if client.parallel > 0:
+            fp.write(b"parallel = %d\n" % client.parallel)
+        if client.tcpsize > 0:
+            fp.write(b"tcpsize = %d\n" % client.tcpsize)
 
         if client.encoding:
             fp.write(b"encoding = %s\n" % client.encoding.encode('ascii'))
@@ -1595,8 +2079,8 @@ def unshelve(ui, repo, changelist, **opts):
     cl = client.describe(changelist, shelve=True)
     p4rev = _get_shelve_base_rev(ui, cl, client)
     try:
-        entries = _entries(repo, client.fstat(files=depot), client, p1=p4rev)
-        getfilectx = _get_getfilectx(entries, client)
+        entries, deleted = _entries(repo, client.fstat(files=depot), client, p1=p4rev)
+        getfilectx = _get_getfilectx(entries, deleted, client)
         ctx = _common_commit(cl, repo, getfilectx, {b'p4': int_to_bytes(c)}, files=list(entries.keys()), p1=p4rev)
 
         ui.note(_(b'added changeset %d:%s\n') % (ctx.rev(), ctx))
@@ -1623,13 +2107,15 @@ def _get_shelve_base_rev(ui, cl, client):
         ui.status(_(b'no files unshelved'))
         return 2
 
-    def _change_for_file_rev(df, file_rev):
-        p4cmd = b'changes -m 1 %s#%d' % (df, file_rev)
+    def _change_for_file_rev(spec):
+        p4cmd = b'changes -m 1 %s#%d' % spec
         d = client.runone(p4cmd)
         c = int(d[b'change'])
         return c
-    changes_low = []
-    changes_high = []
+
+    # p4 changes -m limits the total, so each revision needs its own
+    # command, run them side by side
+    specs = []
     for f in cl.files:
         df = f[0]
         file_rev = f[1]
@@ -1638,8 +2124,12 @@ def _get_shelve_base_rev(ui, cl, client):
             # and add the changelist in which it was created to changes_high
             pass
         else:
-            changes_low.append(_change_for_file_rev(df, file_rev))
-            changes_high.append(_change_for_file_rev(df, file_rev + 1))
+            specs.append((df, file_rev))
+            specs.append((df, file_rev + 1))
+    with futures.ThreadPoolExecutor(client.unshelveparallel) as pool:
+        changes = list(pool.map(_change_for_file_rev, specs))
+    changes_low = changes[0::2]
+    changes_high = changes[1::2]
 
     if ui.debugflag:
         ui.debug(b'changes_low = %r\n' % (changes_low,))
@@ -1727,18 +2217,17 @@ def push(original, ui, repo, dest=None, **opts):
         client.sync(p4id, force=True, files=[client.encodename(f[0]) for f in mod])
 
     # attempt to reuse an existing changelist
-    def noid(d):
-        return client.re_hgid.sub(b"{{}}", d)
-
+    noid = _RE_HGID.sub
     use = b''
-    noiddesc = noid(desc)
+    noiddesc = noid(b"{{}}", desc)
     for d in client.run(b'changes -s pending -c %s -l' % client.client):
-        if noid(d[b'desc']) == noiddesc:
+        if noid(b"{{}}", d[b'desc']) == noiddesc:
             use = d[b'change']
+            break
 
     def rev(files, change=b"", abort=True):
         if files:
-            ui.note(_(b'reverting: %s\n') % b' '.join(f[0] for f in files))
+            if ui.verbose: ui.note(_(b'reverting: %s\n') % b' '.join(f[0] for f in files))
             if change:
                 change = b'-c %s' % int_to_bytes( change)
             client.runs(b'revert %s' % change,
@@ -1754,21 +2243,23 @@ def push(original, ui, repo, dest=None, **opts):
     rev(mod + add + rem, abort=False)
 
     # sort out the copies from the adds
-    rems = {}
-    for f in rem:
-        rems[f[0]] = True
+    rems = set(f[0] for f in rem)
+    moved = set()
 
-    moves = []      # src,dest,mode tuples for p4 move
+    moves = []      # src,dest,mode,encoded src,encoded dest tuples for p4 move
     copies = []     # src,dest tuples for p4 copy
     ntg = []        # integrate
     add2 = []       # additions left after copies removed
     mod2 = []       # list of dest,mode for files modified as well as copied/moved
+    copied = cpy.get
+    append = add2.append
     for f,g in add:
-        if f in cpy:
-            r, chg = cpy[f]
-            if move and r in rems and rems[r]:
-                moves.append((r, f, g))
-                rems[r] = False
+        c = copied(f)
+        if c is not None:
+            r, chg = c
+            if move and r in rems and r not in moved:
+                moves.append((r, f, g, client.encodename(r), client.encodename(f)))
+                moved.add(r)
             elif copy:
                 copies.append((r, f))
             else:
@@ -1776,10 +2267,12 @@ def push(original, ui, repo, dest=None, **opts):
             if chg:
                 mod2.append((f,g))
         else:
-            add2.append((f,g))
+            append((f,g))
     add = add2
+    edited = mod + mod2
+    written = mod + add + mod2
 
-    rem = [r for r in rem if rems[r[0]]]
+    rem = [r for r in rem if r[0] not in moved]
 
     if ui.debugflag:
         ui.debug(b'mod = %r+%r\n' % (mod,mod2))
@@ -1794,7 +2287,7 @@ def push(original, ui, repo, dest=None, **opts):
 
     def modal(note, cmd, files, encoder):
         'Run command grouped by file mode'
-        ui.note(note % b' '.join(f[0] for f in files))
+        if ui.verbose: ui.note(note % b' '.join(f[0] for f in files))
         retype = []
         modes = set(f[1] for f in files)
         for mode in modes:
@@ -1806,7 +2299,7 @@ def push(original, ui, repo, dest=None, **opts):
             opt = opt and b" -t " + opt
             bunch = [os.path.join(client.partial, encoder(f[0])) for f in files if f[1]==mode]
             if bunch:
-                for d in client.run(cmd + opt, files=bunch):
+                for d in client.run(cmd + opt, xargs=bunch):
                     if d[b'code'] == b'stat':
                         basetype, oldmode, keywords, utf16 = client.decodetype(d[b'type'])
                         if mode==b'' and  oldmode==b'x':
@@ -1826,47 +2319,60 @@ def push(original, ui, repo, dest=None, **opts):
         # now add/edit/delete the files
 
         if copies:
-            ui.note(_(b'copying: %s\n') % b' '.join(f[1] for f in copies))
-            for f in copies:
-                client.runs(b'copy -c %s "%s" "%s"' % (use, client.rootpart + f[0], client.rootpart + f[1]))
+            if ui.verbose: ui.note(_(b'copying: %s\n') % b' '.join(f[1] for f in copies))
+            client.runs(b'copy -c %s' % use,
+                        xargs=[(client.rootpart + f[0], client.rootpart + f[1]) for f in copies])
 
         if moves:
             modal(_(b'opening for move: %s\n'), b'edit -c %s' % use,
-                  files=[(client.rootpart + f[0], f[2]) for f in moves], encoder=client.encodename)
+                  files=[(client.rootpart + f[3], f[2]) for f in moves], encoder=lambda n:n)
 
-            ui.note(_(b'moving: %s\n') % b' '.join(f[1] for f in moves))
-            for f in moves:
-                client.runs(b'move -c %s "%s" "%s"' % (
-                    use, client.rootpart + client.encodename(f[0]),
-                    client.rootpart + client.encodename(f[1])))
+            if ui.verbose: ui.note(_(b'moving: %s\n') % b' '.join(f[1] for f in moves))
+            client.runs(b'move -c %s' % use,
+                        xargs=[(client.rootpart + f[3], client.rootpart + f[4]) for f in moves])
 
         if ntg:
-            ui.note(_(b'opening for integrate: %s\n') % b' '.join(f[1] for f in ntg))
+            if ui.verbose: ui.note(_(b'opening for integrate: %s\n') % b' '.join(f[1] for f in ntg))
             for f in ntg:
                 f1 = client.rootpart + f[1]
-                ui.debug(_(b'unlink: %s\n') % f1)
-                try:
+                if ui.debugflag: ui.debug(_(b'unlink: %s\n') % f1)
+                with contextlib.suppress(OSError):
                     os.unlink(f1)
-                except Exception:
-                    pass
-                client.runs(b'integrate -c %s -Di -t "%s" "%s"' % (use, client.rootpart + f[0], f1))
+            client.runs(b'integrate -c %s -Di -t' % use,
+                        xargs=[(client.rootpart + f[0], client.rootpart + f[1]) for f in ntg])
 
-        if mod or mod2:
-            modal(_(b'opening for edit: %s\n'), b'edit -c %s' % use, files=mod + mod2, encoder=client.encodename)
+        if edited:
+            modal(_(b'opening for edit: %s\n'), b'edit -c %s' % use, files=edited, encoder=client.encodename)
 
-        if mod or add or mod2:
+        if written:
             ui.note(_(b'retrieving file contents...\n'))
             opener = scmutil.vfs.vfs(client.rootpart)
 
-            for name, mode in mod + add + mod2:
-                ui.debug(_(b'writing: %s\n') % name)
+            # let extensions storing file contents remotely fetch them in one go
+            prefetchfiles(repo, ctx, [f[0] for f in written])
+
+            def write(name, mode, data):
+                # the opener replaces any existing file, so only the
+                # executable bit is left to set
                 if b'l' in mode:
-                    opener.symlink(ctx[name].data(), name)
+                    opener.symlink(data, name)
                 else:
-                    fp = opener(name, mode=b"w")
-                    fp.write(ctx[name].data())
-                    fp.close()
-                util.setflags(client.localpath(name), b'l' in mode, b'x' in mode)
+                    opener.write(name, data)
+                    if b'x' in mode:
+                        util.setflags(client.localpath(name), False, True)
+
+            # the contents are read from the repository here while the
+            # pool writes the previous files to the workarea, at most 32
+            # files are held in memory and the first error stops the loop
+            writes = collections.deque()
+            with futures.ThreadPoolExecutor(client.pushparallel) as pool:
+                for name, mode in written:
+                    if len(writes) >= 32:
+                        writes.popleft().result()
+                    if ui.debugflag: ui.debug(_(b'writing: %s\n') % name)
+                    writes.append(pool.submit(write, name, mode, ctx[name].data()))
+                for w in writes:
+                    w.result()
 
         if add:
             modal(_(b'opening for add: %s\n'), b'add -f -c %s' % use, files=add, encoder=lambda n:n)
@@ -1926,9 +2432,10 @@ def submit(ui, repo, *changes, **opts):
     opts = pycompat.byteskwargs(opts)
     client, changes = subrevcommon('submit', ui, repo, changes, opts)
 
+    # check that all the changelists exist before submitting any
+    client.describe_many(changes)
     for c in changes:
         ui.status(_(b'submitting: %d\n') % c)
-        cl = client.describe(c)
         client.submit(c)
 
 
@@ -1941,10 +2448,16 @@ def revert(ui, repo, *changes, **opts):
     opts = pycompat.byteskwargs(opts)
     client, changes = subrevcommon('revert', ui, repo, changes, opts)
 
+    # describe them all at once, or one by one to find the failing ones
+    try:
+        cls = dict(zip(changes, client.describe_many(changes)))
+    except Exception:
+        cls = {}
+
     for c in changes:
         ui.status(_(b'reverting: %d\n') % c)
         try:
-            cl = client.describe(c)
+            cl = cls.get(c) or client.describe(c)
         except Exception as e:
             if ui.traceback:ui.traceback()
             ui.warn('%s\n' % e)
@@ -1953,15 +2466,16 @@ def revert(ui, repo, *changes, **opts):
         if cl is not None:
             files = [f[0] for f in cl.files]
             if files:
-                ui.note(_(b'reverting: %s\n') % b' '.join(files))
-                client.runs(b'revert', client=cl.client, files=files, abort=False)
+                if ui.verbose: ui.note(_(b'reverting: %s\n') % b' '.join(files))
+                client.runs(b'revert', client=cl.client, xargs=files, abort=False)
 
             if cl.jobs:
-                ui.note(_(b'unfixing: %s\n') % b' '.join(cl.jobs))
-                client.runs(b'fix -d -c %d' % c, client=cl.client, files=cl.jobs, abort=False)
+                if ui.verbose: ui.note(_(b'unfixing: %s\n') % b' '.join(cl.jobs))
+                client.runs(b'fix -d -c %d' % c, client=cl.client, xargs=cl.jobs, abort=False)
 
             ui.note(_(b'deleting: %d\n') % c)
             client.runs(b'change -d %d' %c , client=cl.client, abort=False)
+            client.invalidate()
 
 
 @command(b"p4pending",
@@ -1975,14 +2489,16 @@ def pending(ui, repo, dest=None, **opts):
     client = p4client(ui, repo, dest)
 
     dolong = opts.get(b'summary')
-    hexfunc = ui.verbose and hex or short
+    hexfunc = hex if ui.verbose else short
     pl = client.getpendinglist()
     if pl:
         w = max(len(str(e[0])) for e in pl)
-        for e in pl:
+        if dolong and ui.verbose:
+            cls = client.describe_many([e[0] for e in pl], local=True)
+        for i, e in enumerate(pl):
             if dolong:
                 if ui.verbose:
-                    cl = client.describe(e[0], local=True)
+                    cl = cls[i]
                 ui.write(_(b'changelist:  %d\n') % e[0])
                 if ui.verbose:
                     ui.write(_(b'client:      %s\n') % e[4])
@@ -2044,7 +2560,7 @@ def identify(ui, repo, *args, **opts):
     doid = opts.get(b'id')
     dop4 = opts.get(b'p4')
     default = not (num or doid or dop4)
-    hexfunc = ui.verbose and hex or short
+    hexfunc = hex if ui.verbose else short
     output = []
 
     if default or dop4: